@@ -3,5 +3,6 @@ Config = SimpleNamespace(
     network="finney",
     wallet="cfusion",
     hotkey="sn1",
-    scoring_url=""
+    scoring_url="",
+    max_fanout=32,
 )
\ No newline at end of file
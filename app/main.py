@@ -1,148 +1,448 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request
-from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from dataclasses import dataclass
 from contextlib import asynccontextmanager
 from typing import Any
-import json
+import logging
+import orjson
+from hashlib import blake2b, sha256
 import httpx
-import time
 import asyncio  
 import bittensor as bt
 from types import SimpleNamespace
-from .utils import get_top_miners, generate_header
+from .utils import get_top_miners, get_top_pool, generate_header
 from .config import Config as config
 from pydantic import BaseModel
+from tenacity import retry, retry_if_exception, stop_after_attempt, stop_after_delay, wait_exponential
+
+logging.basicConfig(level=logging.INFO)
+# httpx logs every request at INFO, which would mean a line per miner POST
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
 
 @dataclass
 class BTResources:
     subtensor: bt.subtensor
     wallet: bt.wallet
+    http_client: httpx.AsyncClient
 
 def get_resources(request: Request) -> BTResources:
     return BTResources(
         subtensor=request.app.state.subtensor,
         wallet=request.app.state.wallet,
+        http_client=request.app.state.http_client,
     )
 
-# Simple in-memory cache for metagraph with 5-minute TTL
+# In-memory metagraph cache, refreshed in the background every 5 minutes
 CACHE_TTL_SECONDS = 300
+# Retry interval while no metagraph has been loaded yet
+METAGRAPH_RETRY_SECONDS = 5
+
+# Bounded queue and worker pool for forwarding responses to the webhook
+WEBHOOK_QUEUE_SIZE = 1000
+# The worker count also caps concurrent POSTs to the webhook host
+WEBHOOK_WORKERS = 4
+# Retry attempts per forward, and the total time a worker may spend on one item
+WEBHOOK_ATTEMPTS = 3
+WEBHOOK_RETRY_SECONDS = 5.0
+
+# Upper bound on how much of a miner response body is buffered in memory. The
+# winner is streamed to the client as it arrives, so a body that grows past this
+# (or stalls past the overall deadline) can no longer fail over to another
+# miner: the stream is ended early and a warning is logged.
+MAX_RESPONSE_BYTES = 10 * 1024 * 1024
+# How much of a response is read before it can win, checked for error text. Just
+# enough to hold a short error body, so real completions start streaming at once;
+# errors appearing later in a longer body are not detected.
+WINNER_PREFIX_BYTES = 64
+
+# Identical prompts share one in-flight fan-out, and its result for this long after
+COALESCE_TTL_SECONDS = 2.0
 
-def get_metagraph_cached(app: FastAPI, subtensor: bt.subtensor):
-    last_ts: float = getattr(app.state, "metagraph_ts", 0.0)
-    cached_value = getattr(app.state, "metagraph_value", None)
-    now = time.time()
+async def _refresh_metagraph(app: FastAPI, subtensor: bt.subtensor) -> None:
+    # subtensor.metagraph is blocking, keep it off the event loop
+    metagraph = await asyncio.to_thread(subtensor.metagraph, 1)
+    app.state.metagraph_value = metagraph
 
-    if cached_value is None or (now - last_ts) >= CACHE_TTL_SECONDS:
-        # Refresh cache
-        cached_value = subtensor.metagraph(1)
-        app.state.metagraph_value = cached_value
-        app.state.metagraph_ts = now
+async def _metagraph_refresher(app: FastAPI) -> None:
+    while True:
+        # Retry quickly until the first metagraph has loaded
+        await asyncio.sleep(CACHE_TTL_SECONDS if app.state.metagraph_value is not None else METAGRAPH_RETRY_SECONDS)
+        try:
+            await _refresh_metagraph(app, app.state.subtensor)
+        except Exception as e:
+            # Keep serving the last good metagraph until the next attempt
+            logger.warning("Metagraph refresh failed: %s", e)
 
-    return cached_value
+def get_metagraph_cached(app: FastAPI):
+    # Readers never block on a refresh; they always see the last good value
+    return app.state.metagraph_value
+
+def get_top_pool_cached(app: FastAPI, metagraph):
+    # Recompute the top-incentive pool only when the cached metagraph is replaced
+    if getattr(app.state, "top_pool_metagraph", None) is not metagraph:
+        app.state.top_pool = get_top_pool(metagraph)
+        app.state.top_pool_metagraph = metagraph
+    return app.state.top_pool
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Instantiate once per process
     app.state.subtensor = bt.subtensor(config.network)
     app.state.wallet = bt.wallet(name=config.wallet, hotkey=config.hotkey)
-    # Initialize metagraph cache placeholders
+    # Metagraph cache, loaded before serving and kept fresh by a background task
     app.state.metagraph_value = None
-    app.state.metagraph_ts = 0.0
+    app.state.top_pool = None
+    app.state.top_pool_metagraph = None
+    # In-flight fan-outs keyed by prompt hash, for coalescing duplicate requests
+    app.state.inflight = {}
+    # Background reads of winning miner bodies, which can outlive their inflight entry
+    app.state.upstream_reads = set()
     # Optional webhook URL for forwarding successful responses
     app.state.forward_webhook_url = config.scoring_url
+    # Shared HTTP clients so connections are pooled and reused across requests
+    app.state.http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=500, keepalive_expiry=60),
+        http2=True,
+        timeout=httpx.Timeout(5.0),
+    )
+    app.state.webhook_client = httpx.AsyncClient(timeout=3.0)
+    # Long-lived workers drain the webhook queue using the shared client
+    app.state.webhook_queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    webhook_workers: list[asyncio.Task] = []
+    metagraph_refresher: asyncio.Task | None = None
     try:
+        webhook_workers = [asyncio.create_task(_webhook_worker(app)) for _ in range(WEBHOOK_WORKERS)]
+        try:
+            await _refresh_metagraph(app, app.state.subtensor)
+        except Exception as e:
+            # Start anyway; the refresher keeps retrying and requests get 503 until it loads
+            logger.warning("Initial metagraph fetch failed: %s", e)
+        metagraph_refresher = asyncio.create_task(_metagraph_refresher(app))
         yield
     finally:
-        pass
-        
+        # Stop fan-outs and body reads before the clients they use are closed
+        running = [*app.state.inflight.values(), *app.state.upstream_reads]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        if metagraph_refresher is not None:
+            metagraph_refresher.cancel()
+            await asyncio.gather(metagraph_refresher, return_exceptions=True)
+        # One sentinel per worker; any items queued ahead of them are still delivered
+        for _ in webhook_workers:
+            await app.state.webhook_queue.put(None)
+        await asyncio.gather(*webhook_workers, return_exceptions=True)
+        await app.state.webhook_client.aclose()
+        await app.state.http_client.aclose()
+
+
+class UpstreamResponse:
+    """A miner response whose body is read once and replayed to every caller that joins it."""
+
+    def __init__(self, response: httpx.Response, chunks, head: list[bytes], complete: bool):
+        self.response = response
+        self.head = b"".join(head)
+        self.pump: asyncio.Task | None = None
+        self.error: Exception | None = None
+        self._chunks = chunks
+        self._buffer = head
+        self._size = len(self.head)
+        self._complete = complete
+        self._done = False
+        self._changed = asyncio.Event()
+
+    def start(self, deadline: float) -> None:
+        # Read the body in the background, independently of any one client connection
+        self.pump = asyncio.create_task(self._read(deadline))
+
+    async def _read(self, deadline: float) -> None:
+        try:
+            if not self._complete:
+                # The rest of the body must arrive within the same overall deadline as the fan-out
+                async with asyncio.timeout_at(deadline):
+                    async for chunk in self._chunks:
+                        self._size += len(chunk)
+                        if self._size > MAX_RESPONSE_BYTES:
+                            # Cap buffering so a misbehaving miner can't exhaust memory
+                            raise ValueError(f"Upstream response exceeds {MAX_RESPONSE_BYTES} bytes")
+                        self._buffer.append(chunk)
+                        self._notify()
+        except Exception as e:
+            # Headers are already sent, so end the stream early rather than fail the client
+            logger.warning("Upstream response from %s ended early: %r", self.response.url, e)
+            self.error = e
+        finally:
+            self._done = True
+            self._notify()
+            await self.response.aclose()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    @property
+    def content(self) -> bytes:
+        return b"".join(self._buffer)
+
+    async def iter_bytes(self):
+        i = 0
+        while True:
+            if i < len(self._buffer):
+                yield self._buffer[i]
+                i += 1
+            elif self._done:
+                return
+            else:
+                await self._changed.wait()
+
+    async def aclose(self) -> None:
+        await self.response.aclose()
+
 
 async def _post_to_miner(
     client: httpx.AsyncClient,
     miner: SimpleNamespace,
-    payload: dict[str, Any],
+    body: bytes,
+    body_hash: str,
     timeout_seconds: float,
     wallet: bt.wallet,
-) -> tuple[SimpleNamespace, httpx.Response, Exception | None]:
+) -> tuple[SimpleNamespace, UpstreamResponse | None, Exception | None]:
         """Query a single miner using the provided HTTP client."""
+        resp = None
         try:
             headers = await generate_header(
-                wallet.hotkey, body=json.dumps(payload).encode("utf-8"), signed_for=miner.hotkey
+                wallet.hotkey, body=body, signed_for=miner.hotkey, body_hash=body_hash
             )
-            resp = await client.post(
+            headers["Content-Type"] = "application/json"
+            req = client.build_request(
+                "POST",
                 f"{miner.address}/v1/chat/completions",
                 headers=headers,
-                content=json.dumps(payload).encode("utf-8"),
+                content=body,
                 timeout=httpx.Timeout(timeout = timeout_seconds),
             )
-            
+            resp = await client.send(req, stream=True)
             resp.raise_for_status()
-            return miner, resp, None
+            # Read a prefix (or the whole body, if shorter) so error bodies sent with a
+            # 2xx status can be rejected; the rest is only read if this miner wins
+            chunks = resp.aiter_bytes()
+            head: list[bytes] = []
+            size = 0
+            complete = False
+            while size < WINNER_PREFIX_BYTES:
+                chunk = await anext(chunks, None)
+                if chunk is None:
+                    complete = True
+                    break
+                head.append(chunk)
+                size += len(chunk)
+            return miner, UpstreamResponse(resp, chunks, head, complete), None
         except Exception as e:
+            if resp is not None:
+                await resp.aclose()
             return miner, None, e
+        except asyncio.CancelledError:
+            if resp is not None:
+                await resp.aclose()
+            raise
 
 
 async def post_to_miners_first(
+    client: httpx.AsyncClient,
     miners: list[SimpleNamespace],
     payload: dict[str, Any],
     wallet: bt.wallet,
     per_request_timeout: float = 20.0,
     overall_timeout: float = 30.0,
+    concurrency: int | None = None,
 ):
-    async with httpx.AsyncClient() as client:
-        tasks = [
-            asyncio.create_task(
-                _post_to_miner(client, miner, payload, per_request_timeout, wallet)
+    if concurrency is None:
+        concurrency = config.max_fanout
+    # The payload is identical for every miner, so serialize and hash it once
+    body = orjson.dumps(payload)
+    body_hash = sha256(body).hexdigest()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + overall_timeout
+    remaining_miners = iter(miners)
+    pending: set[asyncio.Task] = set()
+
+    def _stage() -> None:
+        # Keep at most `concurrency` miner requests in flight, topping up as they finish
+        while len(pending) < concurrency:
+            miner = next(remaining_miners, None)
+            if miner is None:
+                return
+            pending.add(
+                asyncio.create_task(
+                    _post_to_miner(client, miner, body, body_hash, per_request_timeout, wallet)
+                )
             )
-            for miner in miners
-        ]
-        try:
-            for coro in asyncio.as_completed(tasks, timeout=overall_timeout):
-                miner, response, error = await coro
-                if response is not None and response.status_code < 400 and "Internal Server Error" not in response.text:
-                    # Cancel remaining tasks
-                    for t in tasks:
-                        if not t.done():
-                            t.cancel()
-                    return miner, response
-        except asyncio.TimeoutError:
-            pass
-        finally:
-            for t in tasks:
-                if not t.done():
-                    t.cancel()
+
+    try:
+        _stage()
+        while pending:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            winner = None
+            for task in done:
+                miner, upstream, error = task.result()
+                if winner is None and upstream is not None and upstream.response.status_code < 400 and b"Internal Server Error" not in upstream.head:
+                    winner = miner, upstream
+                elif upstream is not None:
+                    # Release losing responses so their connections go back to the pool
+                    await upstream.aclose()
+            if winner is not None:
+                winner[1].start(deadline)
+                return winner
+            _stage()
+    finally:
+        # Cancel and drain whatever is still running; cancelled requests close
+        # their responses on the way out, so the drain also releases their sockets
+        for t in pending:
+            t.cancel()
+        if pending:
+            results = await asyncio.gather(*pending, return_exceptions=True)
+            # Anything that finished before it could be cancelled still holds an open response
+            for result in results:
+                if isinstance(result, tuple) and result[1] is not None:
+                    await result[1].aclose()
     return None, None
 
 
 def _serialize_miner(miner: SimpleNamespace) -> dict[str, Any]:
-    endpoint_ip = getattr(getattr(miner, "endpoint", None), "ip", None)
-    endpoint_port = getattr(getattr(miner, "endpoint", None), "port", None)
+    # Miners from get_top_miners always carry hotkey, address and endpoint
+    endpoint = miner.endpoint
     return {
-        "hotkey": getattr(miner, "hotkey", None),
-        "address": getattr(miner, "address", None),
-        "endpoint_ip": endpoint_ip,
-        "endpoint_port": endpoint_port,
+        "hotkey": miner.hotkey,
+        "address": miner.address,
+        "endpoint_ip": endpoint.ip,
+        "endpoint_port": endpoint.port,
     }
 
 
-async def _forward_webhook(webhook_url: str, miner: SimpleNamespace, prompt: str, upstream_response: httpx.Response) -> None:
+def _is_retryable_webhook_error(exc: BaseException) -> bool:
+    # Retry transport failures/timeouts and 5xx responses, not client errors
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+@retry(
+    stop=stop_after_attempt(WEBHOOK_ATTEMPTS) | stop_after_delay(WEBHOOK_RETRY_SECONDS),
+    wait=wait_exponential(multiplier=0.1, max=1.0),
+    retry=retry_if_exception(_is_retryable_webhook_error),
+    reraise=True,
+)
+async def _post_webhook(client: httpx.AsyncClient, webhook_url: str, content: bytes) -> None:
+    resp = await client.post(
+        webhook_url,
+        content=content,
+        headers={"Content-Type": "application/json"},
+        timeout=3.0,
+    )
+    resp.raise_for_status()
+
+
+async def _forward_webhook(
+    client: httpx.AsyncClient,
+    webhook_url: str,
+    miner: SimpleNamespace,
+    prompt: str,
+    status_code: int,
+    content_type: str | None,
+    body: bytes,
+) -> None:
     try:
         payload: dict[str, Any] = {
             "miner": _serialize_miner(miner),
             "prompt": prompt,
             "response": {
-                "status_code": upstream_response.status_code,
-                "content_type": upstream_response.headers.get("content-type"),
-                "text": upstream_response.text,
+                "status_code": status_code,
+                "content_type": content_type,
+                "text": body.decode("utf-8", errors="replace"),
             },
         }
-        print(f"Forwarding webhook to {webhook_url} with payload: {payload}")
-        async with httpx.AsyncClient() as client:
-            await client.post(webhook_url, json=payload, timeout=3.0)
+        logger.debug("Forwarding webhook to %s for miner %s", webhook_url, miner.hotkey)
+        # Hard cap including in-flight attempts, so a slow webhook can't pin a worker
+        async with asyncio.timeout(WEBHOOK_RETRY_SECONDS):
+            await _post_webhook(client, webhook_url, orjson.dumps(payload))
     except Exception:
         # Intentionally swallow errors to avoid impacting the main request flow
         pass
 
 
+async def _webhook_worker(app: FastAPI) -> None:
+    queue: asyncio.Queue = app.state.webhook_queue
+    while True:
+        item = await queue.get()
+        try:
+            if item is None:
+                return
+            await _forward_webhook(app.state.webhook_client, app.state.forward_webhook_url, *item)
+        finally:
+            queue.task_done()
+
+
+async def _run_completion(app: FastAPI, resources: BTResources, prompt: str):
+    metagraph = get_metagraph_cached(app)
+    if metagraph is None:
+        raise HTTPException(status_code=503, detail="Metagraph not loaded yet")
+    miners = get_top_miners(metagraph, 5, get_top_pool_cached(app, metagraph))
+
+    # Fan out POST requests to miners and return the first successful response
+    payload = {"step": "generator", "query": prompt}
+    miner, upstream = await post_to_miners_first(
+        resources.http_client, miners, payload, resources.wallet,
+        concurrency=min(len(miners), config.max_fanout),
+    )
+
+    if upstream is None:
+        raise HTTPException(status_code=502, detail="No miners responded successfully in time")
+    logger.debug("Upstream response from miner %s: %s", miner.hotkey, upstream.response)
+    app.state.upstream_reads.add(upstream.pump)
+    upstream.pump.add_done_callback(app.state.upstream_reads.discard)
+    # Forward miner/prompt/response to webhook once the body has been fully read
+    webhook_url: str | None = getattr(app.state, "forward_webhook_url", None)
+    if webhook_url:
+        upstream.pump.add_done_callback(lambda _: _enqueue_webhook(app, miner, prompt, upstream))
+    return miner, upstream
+
+
+def _enqueue_webhook(app: FastAPI, miner: SimpleNamespace, prompt: str, upstream: UpstreamResponse) -> None:
+    if upstream.error is not None or upstream.pump.cancelled():
+        return
+    try:
+        app.state.webhook_queue.put_nowait(
+            (miner, prompt, upstream.response.status_code, upstream.response.headers.get("content-type"), upstream.content)
+        )
+    except asyncio.QueueFull:
+        # Drop rather than block when the webhook is backed up
+        pass
+
+
+def _get_or_start_completion(app: FastAPI, key: str, start) -> asyncio.Task:
+    # Join the fan-out already running (or just finished) for this key, else start one
+    task = app.state.inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(start())
+        app.state.inflight[key] = task
+        task.add_done_callback(lambda t: _expire_completion(app, key, t))
+    return task
+
+
+def _expire_completion(app: FastAPI, key: str, task: asyncio.Task) -> None:
+    # Failures are forgotten immediately; successes are reused for a short window
+    if task.cancelled() or task.exception() is not None:
+        app.state.inflight.pop(key, None)
+    else:
+        asyncio.get_running_loop().call_later(COALESCE_TTL_SECONDS, app.state.inflight.pop, key, None)
+
+
 class CompletionRequest(BaseModel):
     prompt: str
 
@@ -171,25 +471,20 @@ def create_application() -> FastAPI:
         resources: BTResources = Depends(get_resources),
     ) -> Response:
         prompt = body.prompt
-        metagraph = get_metagraph_cached(request.app, resources.subtensor)
-        miners = get_top_miners(metagraph, 5)
-
-        # Fan out POST requests to miners and return the first successful response
-        payload = {"step": "generator", "query": prompt}
-        miner, upstream_response = await post_to_miners_first(miners, payload, resources.wallet)
-
-        if upstream_response is None:
-            raise HTTPException(status_code=502, detail="No miners responded successfully in time")
-        print(f"Upstream response: {upstream_response}")
-        print(f"Upstream response text: {upstream_response.text}")
-        # Fire-and-forget forward of miner/prompt/response to webhook if configured
-        webhook_url: str | None = getattr(request.app.state, "forward_webhook_url", None)
-        if webhook_url:
-            asyncio.create_task(_forward_webhook(webhook_url, miner, prompt, upstream_response))
-
-        # Proxy the upstream response back to the client
-        content_type = upstream_response.headers.get("content-type", "application/octet-stream")
-        return Response(content=upstream_response.content, media_type=content_type)
+        # The miner payload is serialized with orjson, which rejects lone surrogates
+        # (valid in JSON, e.g. "\ud800"); reject them here instead of failing the fan-out
+        try:
+            prompt.encode("utf-8")
+        except UnicodeEncodeError:
+            raise HTTPException(status_code=422, detail="prompt must be valid UTF-8 text")
+        key = blake2b(prompt.encode("utf-8", errors="surrogatepass"), digest_size=16).hexdigest()
+        task = _get_or_start_completion(request.app, key, lambda: _run_completion(request.app, resources, prompt))
+        # Shield so one caller disconnecting doesn't cancel the fan-out for the others
+        miner, upstream = await asyncio.shield(task)
+
+        # Stream the upstream body back to the client as it arrives from the miner
+        content_type = upstream.response.headers.get("content-type") or "application/octet-stream"
+        return StreamingResponse(upstream.iter_bytes(), media_type=content_type)
 
     app.include_router(api_v1)
 
@@ -201,5 +496,8 @@ app = create_application()
 
 if __name__ == "__main__":
     # For local development only. In Docker, use the provided CMD.
+    import sys
     import uvicorn
-    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
+    # uvloop/httptools ship with uvicorn[standard] but are unavailable on Windows
+    fast_io = {"loop": "uvloop", "http": "httptools"} if sys.platform != "win32" else {}
+    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True, **fast_io)
@@ -1,4 +1,5 @@
-import random
+import asyncio
+import numpy as np
 from typing import Any
 import time
 from math import ceil
@@ -7,46 +8,78 @@ from uuid import uuid4
 from substrateinterface import Keypair
 from types import SimpleNamespace
 
+_rng = np.random.default_rng()
 
-def get_top_miners(metagraph, n) -> SimpleNamespace:
-    incentives = metagraph.I
-    # Get indices sorted by incentive values in descending order
-    sorted_indices = sorted(range(len(incentives)), key=lambda i: incentives[i], reverse=True)
-    
-    # Get the top 50% of miners
-    top_50_percent_count = len(sorted_indices) // 2
-    top_miners_indices = sorted_indices[:top_50_percent_count]
-    top_miner_uids = random.sample(top_miners_indices, n)
-
-    top_miner_hotkeys = [metagraph.hotkeys[i] for i in top_miner_uids]
-    top_miner_endpoints = [metagraph.axons[i] for i in top_miner_uids]
-    top_miner_addresses = [f"http://{metagraph.axons[idx].ip}:{metagraph.axons[idx].port}" for idx in top_miner_uids]
-    miners = [SimpleNamespace(hotkey=hotkey, endpoint=endpoint, address=address) for hotkey, endpoint, address in zip(top_miner_hotkeys, top_miner_endpoints, top_miner_addresses)]
+
+def get_top_pool(metagraph) -> np.ndarray:
+    incentives = np.asarray(metagraph.I)
+
+    # Get the top 50% of miners by incentive (unordered, O(n) partition)
+    top_50_percent_count = len(incentives) // 2
+    if not top_50_percent_count:
+        return np.empty(0, dtype=np.intp)
+    return np.argpartition(incentives, -top_50_percent_count)[-top_50_percent_count:]
+
+
+def get_top_miners(metagraph, n, top_pool: np.ndarray | None = None) -> SimpleNamespace:
+    # The pool only changes with the metagraph, so callers may pass a precomputed one
+    if top_pool is None:
+        top_pool = get_top_pool(metagraph)
+    # Never ask for more miners than the pool holds, a small metagraph just yields fewer
+    top_miner_uids = _rng.choice(top_pool, size=min(n, len(top_pool)), replace=False).tolist()
+
+    hotkeys = metagraph.hotkeys
+    axons = metagraph.axons
+    miners = []
+    for uid in top_miner_uids:
+        axon = axons[uid]
+        miners.append(
+            SimpleNamespace(hotkey=hotkeys[uid], endpoint=axon, address=f"http://{axon.ip}:{axon.port}")
+        )
     return miners
 
+def _sign_all(hotkey: Keypair, messages: list[str]) -> list[str]:
+    return ["0x" + hotkey.sign(message).hex() for message in messages]
+
 async def generate_header(
     hotkey: Keypair,
     body: bytes,
     signed_for: str | None = None,
+    body_hash: str | None = None,
 ) -> dict[str, Any]:
     timestamp = round(time.time() * 1000)
-    timestamp_interval = ceil(timestamp / 1e4) * 1e4
     uuid = str(uuid4())
+    if body_hash is None:
+        body_hash = sha256(body).hexdigest()
     headers = {
         "Epistula-Version": "2",
         "Epistula-Timestamp": str(timestamp),
         "Epistula-Uuid": uuid,
         "Epistula-Signed-By": hotkey.ss58_address,
-        "Epistula-Request-Signature": "0x"
-        + hotkey.sign(f"{sha256(body).hexdigest()}.{uuid}.{timestamp}.{signed_for or ''}").hex(),
     }
-    if signed_for:
-        headers["Epistula-Signed-For"] = signed_for
-        headers["Epistula-Secret-Signature-0"] = (
-            "0x" + hotkey.sign(str(timestamp_interval - 1) + "." + signed_for).hex()
-        )
-        headers["Epistula-Secret-Signature-1"] = "0x" + hotkey.sign(str(timestamp_interval) + "." + signed_for).hex()
-        headers["Epistula-Secret-Signature-2"] = (
-            "0x" + hotkey.sign(str(timestamp_interval + 1) + "." + signed_for).hex()
+    if not signed_for:
+        # Unsigned-for requests only carry the request signature
+        (headers["Epistula-Request-Signature"],) = await asyncio.to_thread(
+            _sign_all, hotkey, [f"{body_hash}.{uuid}.{timestamp}."]
         )
-    return headers
\ No newline at end of file
+        return headers
+
+    # Kept as a float so the signed strings match what miners verify ("<ms>.0")
+    timestamp_interval = ceil(timestamp / 1e4) * 1e4
+    # Sign everything in one worker-thread hop so ed25519 never runs on the event loop
+    signatures = await asyncio.to_thread(
+        _sign_all,
+        hotkey,
+        [
+            f"{body_hash}.{uuid}.{timestamp}.{signed_for}",
+            f"{timestamp_interval - 1}.{signed_for}",
+            f"{timestamp_interval}.{signed_for}",
+            f"{timestamp_interval + 1}.{signed_for}",
+        ],
+    )
+    headers["Epistula-Request-Signature"] = signatures[0]
+    headers["Epistula-Signed-For"] = signed_for
+    headers["Epistula-Secret-Signature-0"] = signatures[1]
+    headers["Epistula-Secret-Signature-1"] = signatures[2]
+    headers["Epistula-Secret-Signature-2"] = signatures[3]
+    return headers